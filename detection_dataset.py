@@ -22,7 +22,8 @@ import matplotlib.pyplot as plt
 from config import *
 
 class DetectionDataset(Dataset):
-    def __init__(self, fold, is_training, img_size, images=None, augmentation_level=10, crop_source=1024):
+    def __init__(self, fold, is_training, img_size, images=None, augmentation_level=10, crop_source=1024,
+                 preload_mmap=False):
         self.fold = fold
         self.is_training = is_training
         self.img_size = img_size
@@ -33,7 +34,9 @@ class DetectionDataset(Dataset):
         samples = pd.read_csv('../input/stage_1_train_labels.csv')
         samples = samples.merge(pd.read_csv('../input/folds.csv'), on='patientId', how='left')
 
-        if images is None:
+        if preload_mmap:
+            self.images = self.load_images_mmap(samples)
+        elif images is None:
             self.images = self.load_images(samples)
         else:
             self.images = images
@@ -80,6 +83,13 @@ class DetectionDataset(Dataset):
             pickle.dump(images, open(f'{CACHE_DIR}/train_images.pkl', 'wb'))
         return images
 
+    def load_images_mmap(self, samples):
+        build_images_mmap(samples)
+
+        mmap = np.load(f'{CACHE_DIR}/train_images.npy', mmap_mode='r')
+        patient_ids = pickle.load(open(f'{CACHE_DIR}/train_images_ids.pkl', 'rb'))
+        return {patient_id: mmap[i] for i, patient_id in enumerate(patient_ids)}
+
     def load_image(self, patient_id):
         if patient_id in self.images:
             return self.images[patient_id]
@@ -184,6 +194,48 @@ class DetectionDataset(Dataset):
         return sample
 
 
+def build_images_mmap(samples=None):
+    # decode all DICOMs once into a memory mapped array, reads are then served from the page cache
+    # and shared by the loader workers. Images keep the source resolution so annotations and
+    # crop_source apply unchanged.
+    images_fn = f'{CACHE_DIR}/train_images.npy'
+    patient_ids_fn = f'{CACHE_DIR}/train_images_ids.pkl'
+
+    if os.path.exists(images_fn):
+        return
+
+    if samples is None:
+        samples = pd.read_csv('../input/stage_1_train_labels.csv')
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    patient_ids = list(sorted(samples.patientId.unique()))
+
+    # per process temp names, folds may be started in parallel and build the cache at the same time
+    tmp_images_fn = f'{CACHE_DIR}/train_images_tmp_{os.getpid()}.npy'
+    tmp_patient_ids_fn = f'{CACHE_DIR}/train_images_ids_tmp_{os.getpid()}.pkl'
+
+    mmap = None
+    for i, patient_id in enumerate(tqdm(patient_ids)):
+        img = pydicom.read_file(f'{TRAIN_DIR}/{patient_id}.dcm').pixel_array
+        if mmap is None:
+            mmap = np.lib.format.open_memmap(tmp_images_fn, mode='w+', dtype=img.dtype,
+                                             shape=(len(patient_ids),) + img.shape)
+        mmap[i] = img
+    mmap.flush()
+    del mmap
+    with open(tmp_patient_ids_fn, 'wb') as f:
+        pickle.dump(patient_ids, f)
+
+    if os.path.exists(images_fn):
+        # another process finished first
+        os.remove(tmp_images_fn)
+        os.remove(tmp_patient_ids_fn)
+    else:
+        # ids first and images last, so an existing images file always has its ids next to it
+        os.replace(tmp_patient_ids_fn, patient_ids_fn)
+        os.replace(tmp_images_fn, images_fn)
+
+
 def check_dataset():
     with utils.timeit_context('load ds'):
         ds = DetectionDataset(fold=0, is_training=True, img_size=512)
@@ -8,13 +8,35 @@ import pydicom
 import skimage.transform
 import torch
 import cv2
+from torch.utils.data import DataLoader, Dataset
 import utils
 
 import config
-from train import MODELS, p1p2_to_xywh
+from train import MODELS, compile_for_inference, load_model, p1p2_to_xywh, setup_cuda_backends
+
+
+class SubmissionDataset(Dataset):
+    def __init__(self, patient_ids, img_size):
+        self.patient_ids = list(patient_ids)
+        self.img_size = img_size
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def __getitem__(self, idx):
+        patient_id = self.patient_ids[idx]
+        dcm_data = pydicom.read_file(f'{config.TEST_DIR}/{patient_id}.dcm')
+        img = dcm_data.pixel_array
+        # match the [0, 1] range skimage produced for the uint8 pixel data
+        img = img.astype(np.float32) / 255.0
+        img = cv2.resize(img, (self.img_size, self.img_size), interpolation=cv2.INTER_LINEAR)
+        # utils.print_stats('img', img)
+
+        return patient_id, torch.from_numpy(img).unsqueeze(0)
 
 
 def prepare_submission(model_name, run, fold, epoch_num, threshold, submission_name):
+    setup_cuda_backends()
     run_str = '' if run is None or run == '' else f'_{run}'
     predictions_dir = f'../output/oof2/{model_name}{run_str}_fold_{fold}'
     os.makedirs(predictions_dir, exist_ok=True)
@@ -23,64 +45,62 @@ def prepare_submission(model_name, run, fold, epoch_num, threshold, submission_n
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
     checkpoint = f'checkpoints/{model_name}{run_str}_fold_{fold}/{model_name}_{epoch_num:03}.pt'
-    model = torch.load(checkpoint, map_location=device)
-    model = model.to(device)
+    model = load_model(model_name, checkpoint, device)
     model.eval()
+    model = compile_for_inference(model)
 
     sample_submission = pd.read_csv('../input/stage_1_sample_submission.csv')
 
     img_size = model_info.img_size
-    submission = open(f'../submissions/{submission_name}.csv', 'w')
-    submission.write('patientId,PredictionString\n')
+    rows = []
 
-    for patient_id in sample_submission.patientId:
-        dcm_data = pydicom.read_file(f'{config.TEST_DIR}/{patient_id}.dcm')
-        img = dcm_data.pixel_array
-        # img = img / 255.0
-        img = skimage.transform.resize(img, (img_size, img_size), order=1)
-        # utils.print_stats('img', img)
+    dataset = SubmissionDataset(sample_submission.patientId, img_size=img_size)
+    dataloader = DataLoader(dataset, num_workers=8, batch_size=8, shuffle=False, pin_memory=True)
 
-        img_tensor = torch.zeros(1, img_size, img_size, 1)
-        img_tensor[0, :, :, 0] = torch.from_numpy(img)
-        img_tensor = img_tensor.permute(0, 3, 1, 2)
+    for patient_ids, img_batch in dataloader:
+        img_batch = img_batch.to(device, non_blocking=True).contiguous(memory_format=torch.channels_last)
 
-        nms_scores, global_classification, transformed_anchors = \
-            model(img_tensor.cuda(), return_loss=False, return_boxes=True)
+        with torch.cuda.amp.autocast():
+            regression, classification, global_classification, anchors = \
+                model(img_batch, return_loss=False, return_boxes=False, return_raw=True)
 
-        scores = nms_scores.cpu().detach().numpy()
-        category = global_classification.cpu().detach().numpy()
-        boxes = transformed_anchors.cpu().detach().numpy()
-        category = np.exp(category[0, 2]) + 0.1 * np.exp(category[0, 0])
+        # return_raw global classification is already exp-ed, combine on GPU and copy the whole batch at once
+        categories = (global_classification[:, 2] + 0.1 * global_classification[:, 0]).cpu().numpy()
 
-        if len(scores):
-            scores[scores < scores[0] * 0.5] = 0.0
+        for i, patient_id in enumerate(patient_ids):
+            # boxes/nms handle a single image, run them per batch item
+            nms_scores, _, transformed_anchors = model.boxes(
+                img_batch[i:i + 1],
+                regression[i:i + 1],
+                classification[i:i + 1],
+                global_classification[i:i + 1],
+                anchors)
 
-            # if category > 0.5 and scores[0] < 0.2:
-            #     scores[0] *= 2
+            scores, boxes = [t.detach().cpu().numpy() for t in (nms_scores, transformed_anchors)]
+            category = categories[i]
 
-        # threshold = 0.25
-        mask = scores * category * 10 > threshold
+            if len(scores):
+                scores[scores < scores[0] * 0.5] = 0.0
 
-        # threshold = 0.5
-        # mask = scores * 5 > threshold
+                # if category > 0.5 and scores[0] < 0.2:
+                #     scores[0] *= 2
 
-        submission_str = ''
+            # threshold = 0.25
+            mask = scores * category * 10 > threshold
 
-        # plt.imshow(dcm_data.pixel_array)
+            # threshold = 0.5
+            # mask = scores * 5 > threshold
 
-        if np.any(mask):
             boxes_selected = p1p2_to_xywh(boxes[mask])  # x y w h format
             boxes_selected *= 1024.0 / img_size
-            scores_selected = scores[mask]
+            submission_str = ' '.join(f'{s:.3f} {x:.1f} {y:.1f} {w:.1f} {h:.1f}'
+                                      for s, (x, y, w, h) in zip(scores[mask], boxes_selected))
 
-            for i in range(scores_selected.shape[0]):
-                x, y, w, h = boxes_selected[i]
-                submission_str += f' {scores_selected[i]:.3f} {x:.1f} {y:.1f} {w:.1f} {h:.1f}'
-                # plt.gca().add_patch(plt.Rectangle((x,y), width=w, height=h, fill=False, edgecolor='r', linewidth=2))
+            print(f'{patient_id},{submission_str}      {category:.2f}')
+            rows.append((patient_id, submission_str))
 
-        print(f'{patient_id},{submission_str}      {category:.2f}')
-        submission.write(f'{patient_id},{submission_str}\n')
-        # plt.show()
+    pd.DataFrame(rows, columns=['patientId', 'PredictionString']).to_csv(
+        f'../submissions/{submission_name}.csv', index=False)
 
 
 def prepare_submission_multifolds(model_name, run, epoch_nums, threshold, submission_name, use_global_cat):
@@ -96,8 +116,7 @@ def prepare_submission_multifolds(model_name, run, epoch_nums, threshold, submis
         for fold in range(4):
             checkpoint = f'checkpoints/{model_name}{run_str}_fold_{fold}/{model_name}_{epoch_num:03}.pt'
             print('load', checkpoint)
-            model = torch.load(checkpoint, map_location=device)
-            model = model.to(device)
+            model = load_model(model_name, checkpoint, device)
             model.eval()
             models.append(model)
 
@@ -107,6 +126,9 @@ def prepare_submission_multifolds(model_name, run, epoch_nums, threshold, submis
     submission = open(f'../submissions/{submission_name}.csv', 'w')
     submission.write('patientId,PredictionString\n')
 
+    # reused host buffer for every image, pinned so the copy to GPU can be async
+    img_pinned = torch.empty((1, 1, img_size, img_size), dtype=torch.float32, pin_memory=True)
+
     for patient_id in sample_submission.patientId:
         dcm_data = pydicom.read_file(f'{config.TEST_DIR}/{patient_id}.dcm')
         img = dcm_data.pixel_array
@@ -114,10 +136,8 @@ def prepare_submission_multifolds(model_name, run, epoch_nums, threshold, submis
         img = skimage.transform.resize(img, (img_size, img_size), order=1)
         # utils.print_stats('img', img)
 
-        img_tensor = torch.zeros(1, img_size, img_size, 1)
-        img_tensor[0, :, :, 0] = torch.from_numpy(img)
-        img_tensor = img_tensor.permute(0, 3, 1, 2)
-        img_tensor = img_tensor.cuda()
+        img_pinned[0, 0].copy_(torch.from_numpy(img))
+        img_tensor = img_pinned.to(device, non_blocking=True)
 
         model_raw_results = []
         for model in models:
@@ -178,6 +198,9 @@ def prepare_test_predictions(model_name, run, epoch_num):
     img_size = model_info.img_size
     # print('epoch', epoch_num)
 
+    # reused host buffer for every image, pinned so the copy to GPU can be async
+    img_pinned = torch.empty((1, 1, img_size, img_size), dtype=torch.float32, pin_memory=True)
+
     for fold in range(4):
         print('fold', fold)
         output_dir = f'{config.TEST_PREDICTIONS_DIR}/{model_name}{run_str}_fold_{fold}/{epoch_num:03}/'
@@ -185,8 +208,7 @@ def prepare_test_predictions(model_name, run, epoch_num):
 
         checkpoint = f'checkpoints/{model_name}{run_str}_fold_{fold}/{model_name}_{epoch_num:03}.pt'
         print('load', checkpoint)
-        model = torch.load(checkpoint, map_location=device)
-        model = model.to(device)
+        model = load_model(model_name, checkpoint, device)
         model.eval()
         models.append(model)
 
@@ -202,10 +224,8 @@ def prepare_test_predictions(model_name, run, epoch_num):
                 img = img.astype(np.float32) / 255.0
             # utils.print_stats('img', img)
 
-            img_tensor = torch.zeros(1, img_size, img_size, 1)
-            img_tensor[0, :, :, 0] = torch.from_numpy(img)
-            img_tensor = img_tensor.permute(0, 3, 1, 2)
-            img_tensor = img_tensor.cuda()
+            img_pinned[0, 0].copy_(torch.from_numpy(img))
+            img_tensor = img_pinned.to(device, non_blocking=True)
 
             model_raw_results = model(img_tensor, return_loss=False, return_boxes=False, return_raw=True)
             # discard last item - anchors
@@ -222,8 +242,7 @@ def prepare_submission_from_saved(model_name, run, epoch_nums, threshold, submis
 
     checkpoint = f'checkpoints/{model_name}{run_str}_fold_0/{model_name}_{epoch_nums[0]:03}.pt'
     print('load', checkpoint)
-    model = torch.load(checkpoint, map_location=device)
-    model = model.to(device)
+    model = load_model(model_name, checkpoint, device)
     model.eval()
 
     img_size = model_info.img_size
@@ -378,8 +397,9 @@ if __name__ == '__main__':
     fold = args.fold
 
     if action == 'prepare_submission':
-        prepare_submission(model_name=model, run=args.run, fold=args.fold, epoch_num=args.epoch,
-                           threshold=args.threshold, submission_name=args.submission)
+        with torch.no_grad():
+            prepare_submission(model_name=model, run=args.run, fold=args.fold, epoch_num=args.epoch,
+                               threshold=args.threshold, submission_name=args.submission)
 
     if action == 'prepare_submission_multifolds':
         with torch.no_grad():
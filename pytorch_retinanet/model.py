@@ -335,6 +335,11 @@ class RetinaNet(nn.Module):
 
         global_classification = self.globalClassificationModel(x4)
 
+        # heads may run in fp16 under autocast, losses and nms expect fp32
+        regression = regression.float()
+        classification = classification.float()
+        global_classification = global_classification.float()
+
         anchors = self.anchors(img_batch)
 
         if return_raw:
@@ -1,5 +1,6 @@
 import argparse
 import collections
+import datetime
 import os
 import pickle
 import pandas as pd
@@ -11,6 +12,7 @@ import torch
 import torch.optim as optim
 from torch.optim import lr_scheduler
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import datasets, models, transforms
 from tqdm import tqdm
 import metric
@@ -280,9 +282,56 @@ MODELS = {
 }
 
 
+def load_model(model_name, checkpoint, device):
+    model_info = MODELS[model_name]
+    # weights come from the checkpoint, no need to fetch the pretrained encoder
+    model = model_info.factory(**dict(model_info.args, pretrained=False))
+    model.load_state_dict(torch.load(checkpoint, map_location=device)['model'])
+    return model.to(device, memory_format=torch.channels_last)
+
+
+def setup_cuda_backends():
+    # input sizes are fixed per model, let cudnn pick the fastest conv algorithms once
+    torch.backends.cudnn.benchmark = True
+    # allow TF32 for fp32 matmuls on Ampere+, not available on older PyTorch
+    if hasattr(torch, 'set_float32_matmul_precision'):
+        torch.set_float32_matmul_precision('high')
+
+
+def compile_for_inference(model):
+    # torch.compile is PyTorch 2.x only, older versions run the model eagerly
+    if hasattr(torch, 'compile'):
+        return torch.compile(model, mode='reduce-overhead', fullgraph=False)
+    return model
+
+
 def train(model_name, fold, run=None, resume_weights='', resume_epoch=0):
+    setup_cuda_backends()
     model_info = MODELS[model_name]
 
+    # when started with torchrun (WORLD_SIZE is set) train with one process per GPU,
+    # otherwise fall back to a single process using DataParallel over all visible GPUs
+    distributed = 'WORLD_SIZE' in os.environ
+    if distributed:
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        # build the images cache before the process group exists, so no collective waits on it;
+        # the other ranks wait in the rendezvous, the timeout covers a first run decoding all DICOMs
+        if local_rank == 0:
+            detection_dataset.build_images_mmap()
+        torch.cuda.set_device(local_rank)
+        torch.distributed.init_process_group(backend='nccl', timeout=datetime.timedelta(hours=3))
+        world_size = torch.distributed.get_world_size()
+        is_master = torch.distributed.get_rank() == 0
+    else:
+        world_size = 1
+        is_master = True
+
+    # model_info.batch_size is the total batch, each process loads an equal share of it
+    assert model_info.batch_size % world_size == 0, \
+        f'batch size {model_info.batch_size} of {model_name} is not divisible by {world_size} processes'
+
+    scaler = torch.cuda.amp.GradScaler()
+
     run_str = '' if run is None or run == '' else f'_{run}'
 
     checkpoints_dir = f'checkpoints/{model_name}{run_str}_fold_{fold}'
@@ -293,33 +342,55 @@ def train(model_name, fold, run=None, resume_weights='', resume_epoch=0):
     os.makedirs(predictions_dir, exist_ok=True)
     print('\n', model_name, '\n')
 
-    logger = Logger(tensorboard_dir)
+    logger = Logger(tensorboard_dir) if is_master else None
 
     retinanet = model_info.factory(**model_info.args)
 
     if resume_weights != '':
         print('load model from', resume_weights)
-        retinanet = torch.load(resume_weights).cuda()
+        resume_checkpoint = torch.load(resume_weights, map_location='cpu')
+        retinanet.load_state_dict(resume_checkpoint['model'])
+
+    retinanet = retinanet.cuda()
+    retinanet = retinanet.to(memory_format=torch.channels_last)
+
+    if distributed:
+        # several encoders keep unused pretrainedmodels classifier heads (fc / last_linear) which never get gradients
+        retinanet = torch.nn.parallel.DistributedDataParallel(retinanet, device_ids=[local_rank],
+                                                              find_unused_parameters=True)
     else:
-        retinanet = retinanet.cuda()
+        retinanet = torch.nn.DataParallel(retinanet).cuda()
 
-    retinanet = torch.nn.DataParallel(retinanet).cuda()
+    dataset_train = DetectionDataset(fold=fold, img_size=model_info.img_size, is_training=True, preload_mmap=True,
+                                     **model_info.dataset_args)
+    dataset_valid = DetectionDataset(fold=fold, img_size=model_info.img_size, is_training=False, preload_mmap=True)
 
-    dataset_train = DetectionDataset(fold=fold, img_size=model_info.img_size, is_training=True, images={}, **model_info.dataset_args)
-    dataset_valid = DetectionDataset(fold=fold, img_size=model_info.img_size, is_training=False, images={})
+    sampler_train = DistributedSampler(dataset_train) if distributed else None
 
+    # model_info.batch_size is the total batch, as it was split across GPUs by DataParallel
     dataloader_train = DataLoader(dataset_train,
                                   num_workers=16,
-                                  batch_size=model_info.batch_size,
-                                  shuffle=True,
+                                  batch_size=model_info.batch_size // world_size,
+                                  shuffle=sampler_train is None,
+                                  sampler=sampler_train,
                                   drop_last=True,
+                                  pin_memory=True,
+                                  persistent_workers=True,
+                                  prefetch_factor=4,
                                   collate_fn=pytorch_retinanet.dataloader.collater2d)
 
+    # each rank validates its own shard, the loss sums are all_reduce-d after the epoch
+    sampler_valid = DistributedSampler(dataset_valid, shuffle=False, drop_last=True) if distributed else None
+
     dataloader_valid = DataLoader(dataset_valid,
                                   num_workers=8,
                                   batch_size=4,
                                   shuffle=False,
+                                  sampler=sampler_valid,
                                   drop_last=True,
+                                  pin_memory=True,
+                                  persistent_workers=True,
+                                  prefetch_factor=4,
                                   collate_fn=pytorch_retinanet.dataloader.collater2d)
 
     retinanet.training = True
@@ -349,13 +420,23 @@ def train(model_name, fold, run=None, resume_weights='', resume_epoch=0):
         scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, patience=4, verbose=True, factor=0.2)
         scheduler_by_epoch = False
 
+    if resume_weights != '':
+        optimizer.load_state_dict(resume_checkpoint['optimizer'])
+        scaler.load_state_dict(resume_checkpoint['scaler'])
+
     retinanet.train()
     retinanet.module.freeze_bn()
 
     print('Num training images: {}'.format(len(dataset_train)))
     epochs = 32
 
+    # batch counts do not change between epochs
+    n_train = len(dataloader_train)
+    n_valid = len(dataloader_valid)
+
     for epoch_num in range(resume_epoch+1, epochs):
+        if distributed:
+            sampler_train.set_epoch(epoch_num)
 
         retinanet.train()
         if epoch_num < 1:
@@ -365,69 +446,97 @@ def train(model_name, fold, run=None, resume_weights='', resume_epoch=0):
 
         retinanet.module.freeze_bn()
 
-        epoch_loss = []
-        loss_cls_hist = []
-        loss_cls_global_hist = []
-        loss_reg_hist = []
+        # rolling window for the progress bar, epoch totals for the logger
+        loss_hist = collections.deque(maxlen=100)
+        loss_cls_hist = collections.deque(maxlen=100)
+        loss_cls_global_hist = collections.deque(maxlen=100)
+        loss_reg_hist = collections.deque(maxlen=100)
+        sum_loss = sum_cls = sum_cls_global = sum_reg = 0.0
+        nb_iters = 0
 
         with torch.set_grad_enabled(True):
-            data_iter = tqdm(enumerate(dataloader_train), total=len(dataloader_train))
+            data_iter = tqdm(enumerate(dataloader_train), total=n_train, disable=not is_master)
             for iter_num, data in data_iter:
-                optimizer.zero_grad()
-                inputs = [data['img'].cuda().float(), data['annot'].cuda().float(), data['category'].cuda()]
+                optimizer.zero_grad(set_to_none=True)
+                img = data['img'].cuda(non_blocking=True).float().to(memory_format=torch.channels_last)
+                inputs = [img, data['annot'].cuda(non_blocking=True).float(), data['category'].cuda(non_blocking=True)]
                 # print([i.shape for i in inputs])
 
-                classification_loss, regression_loss, global_classification_loss = \
-                    retinanet(inputs, return_loss=True, return_boxes=False)
+                with torch.cuda.amp.autocast():
+                    classification_loss, regression_loss, global_classification_loss = \
+                        retinanet(inputs, return_loss=True, return_boxes=False)
 
-                classification_loss = classification_loss.mean()
-                regression_loss = regression_loss.mean()
-                global_classification_loss = global_classification_loss.mean()
+                    classification_loss = classification_loss.mean()
+                    regression_loss = regression_loss.mean()
+                    global_classification_loss = global_classification_loss.mean()
 
-                loss = classification_loss + regression_loss + global_classification_loss * 0.1
+                    loss = classification_loss + regression_loss + global_classification_loss * 0.1
 
                 # if bool(loss == 0):
                 #     continue
 
-                loss.backward()
+                scaler.scale(loss).backward()
 
+                # unscale before clipping so the threshold applies to the real gradients
+                scaler.unscale_(optimizer)
                 torch.nn.utils.clip_grad_norm_(retinanet.parameters(), 0.05)
 
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
 
-                loss_cls_hist.append(float(classification_loss))
-                loss_cls_global_hist.append(float(global_classification_loss))
-                loss_reg_hist.append(float(regression_loss))
-                epoch_loss.append(float(loss))
+                # single device to host copy per step instead of one sync per float()
+                cls_f, cls_global_f, reg_f, loss_f = torch.stack(
+                    [classification_loss, global_classification_loss, regression_loss, loss]).detach().cpu().tolist()
+
+                loss_cls_hist.append(cls_f)
+                loss_cls_global_hist.append(cls_global_f)
+                loss_reg_hist.append(reg_f)
+                loss_hist.append(loss_f)
+
+                sum_cls += cls_f
+                sum_cls_global += cls_global_f
+                sum_reg += reg_f
+                sum_loss += loss_f
+                nb_iters += 1
 
                 data_iter.set_description(
-                    f'{epoch_num} cls: {np.mean(loss_cls_hist):1.4f} cls g: {np.mean(loss_cls_global_hist):1.4f} Reg: {np.mean(loss_reg_hist):1.4f} Loss: {np.mean(epoch_loss):1.4f}')
+                    f'{epoch_num} cls: {sum(loss_cls_hist) / len(loss_cls_hist):1.4f} '
+                    f'cls g: {sum(loss_cls_global_hist) / len(loss_cls_global_hist):1.4f} '
+                    f'Reg: {sum(loss_reg_hist) / len(loss_reg_hist):1.4f} '
+                    f'Loss: {sum(loss_hist) / len(loss_hist):1.4f}')
 
                 del classification_loss
                 del regression_loss
 
-        torch.save(retinanet.module, f'{checkpoints_dir}/{model_name}_{epoch_num:03}.pt')
+        if is_master:
+            torch.save({
+                'epoch': epoch_num,
+                'model': retinanet.module.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scaler': scaler.state_dict()
+            }, f'{checkpoints_dir}/{model_name}_{epoch_num:03}.pt')
 
-        logger.scalar_summary('loss_train', np.mean(epoch_loss), epoch_num)
-        logger.scalar_summary('loss_train_classification', np.mean(loss_cls_hist), epoch_num)
-        logger.scalar_summary('loss_train_global_classification', np.mean(loss_cls_global_hist), epoch_num)
-        logger.scalar_summary('loss_train_regression', np.mean(loss_reg_hist), epoch_num)
+            logger.scalar_summary('loss_train', sum_loss / nb_iters, epoch_num)
+            logger.scalar_summary('loss_train_classification', sum_cls / nb_iters, epoch_num)
+            logger.scalar_summary('loss_train_global_classification', sum_cls_global / nb_iters, epoch_num)
+            logger.scalar_summary('loss_train_regression', sum_reg / nb_iters, epoch_num)
 
         # validation
-        with torch.no_grad():
+        with torch.no_grad(), torch.cuda.amp.autocast():
             retinanet.eval()
 
-            loss_hist_valid = []
-            loss_cls_hist_valid = []
-            loss_cls_global_hist_valid = []
-            loss_reg_hist_valid = []
+            sum_loss = sum_cls = sum_cls_global = sum_reg = 0.0
+            nb_iters = 0
 
             # oof = collections.defaultdict(list)
 
-            data_iter = tqdm(enumerate(dataloader_valid), total=len(dataloader_valid))
+            data_iter = tqdm(enumerate(dataloader_valid), total=n_valid, disable=not is_master)
             for iter_num, data in data_iter:
-                res = retinanet([data['img'].cuda().float(), data['annot'].cuda().float(), data['category'].cuda()],
-                                       return_loss=True, return_boxes=False)
+                img = data['img'].cuda(non_blocking=True).float().to(memory_format=torch.channels_last)
+                res = retinanet([img,
+                                 data['annot'].cuda(non_blocking=True).float(),
+                                 data['category'].cuda(non_blocking=True)],
+                                return_loss=True, return_boxes=False)
                 # classification_loss, regression_loss, global_classification_loss, nms_scores, global_class, transformed_anchors = res
                 classification_loss, regression_loss, global_classification_loss = res
 
@@ -443,21 +552,34 @@ def train(model_name, fold, run=None, resume_weights='', resume_epoch=0):
                 global_classification_loss = global_classification_loss.mean()
                 loss = classification_loss + regression_loss + global_classification_loss * 0.1
 
-                loss_hist_valid.append(float(loss))
-                loss_cls_hist_valid.append(float(classification_loss))
-                loss_cls_global_hist_valid.append(float(global_classification_loss))
-                loss_reg_hist_valid.append(float(regression_loss))
+                cls_f, cls_global_f, reg_f, loss_f = torch.stack(
+                    [classification_loss, global_classification_loss, regression_loss, loss]).cpu().tolist()
+
+                sum_loss += loss_f
+                sum_cls += cls_f
+                sum_cls_global += cls_global_f
+                sum_reg += reg_f
+                nb_iters += 1
 
                 data_iter.set_description(
-                    f'{epoch_num} cls: {np.mean(loss_cls_hist_valid):1.4f} cls g: {np.mean(loss_cls_global_hist_valid):1.4f} Reg: {np.mean(loss_reg_hist_valid):1.4f} Loss {np.mean(loss_hist_valid):1.4f}')
+                    f'{epoch_num} cls: {sum_cls / nb_iters:1.4f} cls g: {sum_cls_global / nb_iters:1.4f} '
+                    f'Reg: {sum_reg / nb_iters:1.4f} Loss {sum_loss / nb_iters:1.4f}')
 
                 del classification_loss
                 del regression_loss
 
-            logger.scalar_summary('loss_valid', np.mean(loss_hist_valid), epoch_num)
-            logger.scalar_summary('loss_valid_classification', np.mean(loss_cls_hist_valid), epoch_num)
-            logger.scalar_summary('loss_valid_global_classification', np.mean(loss_cls_global_hist_valid), epoch_num)
-            logger.scalar_summary('loss_valid_regression', np.mean(loss_reg_hist_valid), epoch_num)
+            if distributed:
+                # every rank gets the same totals, so ReduceLROnPlateau steps identically everywhere
+                totals = torch.tensor([sum_loss, sum_cls, sum_cls_global, sum_reg, nb_iters],
+                                      dtype=torch.float64, device='cuda')
+                torch.distributed.all_reduce(totals)
+                sum_loss, sum_cls, sum_cls_global, sum_reg, nb_iters = totals.tolist()
+
+            if is_master:
+                logger.scalar_summary('loss_valid', sum_loss / nb_iters, epoch_num)
+                logger.scalar_summary('loss_valid_classification', sum_cls / nb_iters, epoch_num)
+                logger.scalar_summary('loss_valid_global_classification', sum_cls_global / nb_iters, epoch_num)
+                logger.scalar_summary('loss_valid_regression', sum_reg / nb_iters, epoch_num)
 
             # pickle.dump(oof, open(f'{predictions_dir}/{epoch_num:03}.pkl', 'wb'))
             #
@@ -472,20 +594,29 @@ def train(model_name, fold, run=None, resume_weights='', resume_epoch=0):
         if scheduler_by_epoch:
             scheduler.step(epoch=epoch_num)
         else:
-            scheduler.step(np.mean(loss_reg_hist_valid))
+            scheduler.step(sum_reg / nb_iters)
         # if epoch_num % 4 == 0:
 
 
     retinanet.eval()
-    torch.save(retinanet, f'{checkpoints_dir}/{model_name}_final.pt')
+    if is_master:
+        torch.save({
+            'epoch': epochs - 1,
+            'model': retinanet.module.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scaler': scaler.state_dict()
+        }, f'{checkpoints_dir}/{model_name}_final.pt')
+
+    if distributed:
+        torch.distributed.destroy_process_group()
 
 
 def check(model_name, fold, checkpoint):
+    setup_cuda_backends()
     model_info = MODELS[model_name]
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    model = torch.load(checkpoint, map_location=device)
-    model = model.to(device)
+    model = load_model(model_name, checkpoint, device)
     model.eval()
 
     dataset_valid = DetectionDataset(fold=fold, img_size=model_info.img_size, is_training=False,
@@ -495,13 +626,16 @@ def check(model_name, fold, checkpoint):
                                   num_workers=1,
                                   batch_size=1,
                                   shuffle=False,
+                                  pin_memory=True,
                                   collate_fn=pytorch_retinanet.dataloader.collater2d)
 
     data_iter = tqdm(enumerate(dataloader_valid), total=len(dataloader_valid))
     for iter_num, data in data_iter:
-        classification_loss, regression_loss, global_classification_loss, nms_scores, nms_class, transformed_anchors = \
-            model([data['img'].to(device).float(), data['annot'].to(device).float(), data['category'].cuda()],
-                  return_loss=True, return_boxes=True)
+        img = data['img'].to(device, non_blocking=True).float().to(memory_format=torch.channels_last)
+        with torch.cuda.amp.autocast():
+            classification_loss, regression_loss, global_classification_loss, nms_scores, nms_class, transformed_anchors = \
+                model([img, data['annot'].to(device, non_blocking=True).float(), data['category'].cuda(non_blocking=True)],
+                      return_loss=True, return_boxes=True)
 
         nms_scores = nms_scores.cpu().detach().numpy()
         nms_class = nms_class.cpu().detach().numpy()
@@ -546,6 +680,7 @@ def check(model_name, fold, checkpoint):
 
 
 def generate_predictions(model_name, run, fold, from_epoch=0, to_epoch=100):
+    setup_cuda_backends()
     run_str = '' if run is None or run == '' else f'_{run}'
     predictions_dir = f'../output/oof2/{model_name}{run_str}_fold_{fold}'
     os.makedirs(predictions_dir, exist_ok=True)
@@ -553,6 +688,23 @@ def generate_predictions(model_name, run, fold, from_epoch=0, to_epoch=100):
     model_info = MODELS[model_name]
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+    model = model_info.factory(**dict(model_info.args, pretrained=False))
+    model = model.to(device, memory_format=torch.channels_last)
+    model.eval()
+    # checkpoints are loaded into model in place, compiled_model shares its parameters
+    compiled_model = compile_for_inference(model)
+
+    # built once for all epochs, samples are read in this process so decoded images stay cached
+    dataset_valid = DetectionDataset(fold=fold, img_size=model_info.img_size, is_training=False,
+                                     images={})
+
+    dataloader_valid = DataLoader(dataset_valid,
+                                  num_workers=2,
+                                  batch_size=1,
+                                  shuffle=False,
+                                  pin_memory=True,
+                                  collate_fn=pytorch_retinanet.dataloader.collater2d)
+
     for epoch_num in range(from_epoch, to_epoch):
         prediction_fn = f'{predictions_dir}/{epoch_num:03}.pkl'
         if os.path.exists(prediction_fn):
@@ -561,33 +713,22 @@ def generate_predictions(model_name, run, fold, from_epoch=0, to_epoch=100):
         checkpoint = f'checkpoints/{model_name}{run_str}_fold_{fold}/{model_name}_{epoch_num:03}.pt'
         print('load', checkpoint)
         try:
-            model = torch.load(checkpoint, map_location=device)
+            model.load_state_dict(torch.load(checkpoint, map_location=device)['model'])
         except FileNotFoundError:
             break
-        model = model.to(device)
-        model.eval()
-
-        dataset_valid = DetectionDataset(fold=fold, img_size=model_info.img_size, is_training=False,
-                                         images={})
-
-        dataloader_valid = DataLoader(dataset_valid,
-                                      num_workers=2,
-                                      batch_size=1,
-                                      shuffle=False,
-                                      collate_fn=pytorch_retinanet.dataloader.collater2d)
 
         oof = collections.defaultdict(list)
 
         # for iter_num, data in tqdm(enumerate(dataloader_valid), total=len(dataloader_valid)):
         for iter_num, data in tqdm(enumerate(dataset_valid), total=len(dataloader_valid)):
             data = pytorch_retinanet.dataloader.collater2d([data])
-            img = data['img'].to(device).float()
-            nms_scores, global_classification, transformed_anchors = \
-                model(img, return_loss=False, return_boxes=True)
+            img = data['img'].to(device, non_blocking=True).float().to(memory_format=torch.channels_last)
+            with torch.cuda.amp.autocast():
+                nms_scores, global_classification, transformed_anchors = \
+                    compiled_model(img, return_loss=False, return_boxes=True)
 
-            nms_scores = nms_scores.cpu().detach().numpy()
-            global_classification = global_classification.cpu().detach().numpy()
-            transformed_anchors = transformed_anchors.cpu().detach().numpy()
+            nms_scores, global_classification, transformed_anchors = \
+                [t.detach().cpu().numpy() for t in (nms_scores, global_classification, transformed_anchors)]
 
             oof['gt_boxes'].append(data['annot'].cpu().detach().numpy())
             oof['gt_category'].append(data['category'].cpu().detach().numpy())
@@ -600,10 +741,8 @@ def generate_predictions(model_name, run, fold, from_epoch=0, to_epoch=100):
 
 
 def p1p2_to_xywh(p1p2):
-    xywh = np.zeros((p1p2.shape[0], 4))
-
-    xywh[:, :2] = p1p2[:, :2]
-    xywh[:, 2:4] = p1p2[:, 2:4] - p1p2[:, :2]
+    xywh = p1p2[:, :4].astype(np.float64, copy=True)
+    xywh[:, 2:4] -= xywh[:, :2]
     return xywh
 
 
@@ -624,36 +763,45 @@ def check_metric(model_name, run, fold):
         print('epoch ', epoch_num)
         epoch_scores = []
         nb_images = len(oof['scores'])
-        for threshold in thresholds:
-            threshold_scores = []
-            for img_id in range(nb_images):
-                gt_boxes = oof['gt_boxes'][img_id][0].copy()
 
-                boxes = oof['boxes'][img_id].copy()
-                scores = oof['scores'][img_id].copy()
-                category = oof['category'][img_id]
+        # per image preprocessing does not depend on the threshold, do it once per epoch
+        gt_boxes_xywh = []
+        boxes_xywh = []
+        images_scores = []
+        images_scores_x5 = []
+        for img_id in range(nb_images):
+            gt_boxes = oof['gt_boxes'][img_id][0]
+            scores = oof['scores'][img_id].copy()
+            # category = np.exp(oof['category'][img_id][0, 2])
 
-                category = np.exp(category[0, 2])
+            if len(scores):
+                scores[scores < scores[0]*0.5] = 0.0
 
-                if len(scores):
-                    scores[scores < scores[0]*0.5] = 0.0
+                # if category > 0.5 and scores[0] < 0.2:
+                #     scores[0] *= 2
 
-                    # if category > 0.5 and scores[0] < 0.2:
-                    #     scores[0] *= 2
+            gt_boxes_xywh.append(None if gt_boxes[0, 4] == -1.0 else p1p2_to_xywh(gt_boxes))
+            boxes_xywh.append(p1p2_to_xywh(oof['boxes'][img_id]))
+            images_scores.append(scores)
+            # images_scores_x5.append(scores * category * 10)
+            images_scores_x5.append(scores * 5)
 
-                # mask = scores * category * 10 > threshold
-                mask = scores * 5 > threshold
+        for threshold in thresholds:
+            threshold_scores = []
+            for img_id in range(nb_images):
+                scores = images_scores[img_id]
+                mask = images_scores_x5[img_id] > threshold
 
-                if gt_boxes[0, 4] == -1.0:
+                if gt_boxes_xywh[img_id] is None:
                     if np.any(mask):
                         threshold_scores.append(0.0)
                 else:
-                    if len(scores[mask]) == 0:
+                    if not np.any(mask):
                         score = 0.0
                     else:
                         score = metric.map_iou(
-                            boxes_true=p1p2_to_xywh(gt_boxes),
-                            boxes_pred=p1p2_to_xywh(boxes[mask]),
+                            boxes_true=gt_boxes_xywh[img_id],
+                            boxes_pred=boxes_xywh[img_id][mask],
                             scores=scores[mask])
                     # print(score)
                     threshold_scores.append(score)
@@ -668,6 +816,12 @@ def check_metric(model_name, run, fold):
 
 
 if __name__ == '__main__':
+    # single process training (DataParallel over all visible GPUs):
+    #   python train.py train --model resnet34_512 --fold 0
+    # one process per GPU with DistributedDataParallel:
+    #   torchrun --nproc_per_node=<nb_gpus> train.py train --model resnet34_512 --fold 0
+    # the training images cache is built on the first run, or ahead of time with:
+    #   python train.py build_images_cache
     parser = argparse.ArgumentParser()
     parser.add_argument('action', type=str, default='check')
     parser.add_argument('--model', type=str, default='')
@@ -688,6 +842,9 @@ if __name__ == '__main__':
     model = args.model
     fold = args.fold
 
+    if action == 'build_images_cache':
+        detection_dataset.build_images_mmap()
+
     if action == 'train':
         train(model_name=model, run=args.run, fold=args.fold, resume_weights=args.resume_weights, resume_epoch=args.resume_epoch)
 